@@ -3,8 +3,10 @@ matrixd backend client
 """
 
 import asyncio
+import logging
 
-from typing import TYPE_CHECKING, Optional, Tuple
+from typing import (TYPE_CHECKING, Any, Callable, Dict, List, Optional,
+                    Tuple)
 from types import SimpleNamespace
 
 # nuqq-based imports
@@ -19,19 +21,104 @@ if TYPE_CHECKING:   # imports for typing
     # pylint: disable=ungrouped-imports
     from nuqql_based.account import Account  # noqa
 
+# message creation functions and templates used for every event or buddy,
+# bound once here
+_chat_msg = Message.chat_msg
+_chat_user_msg = Message.chat_user
+_chat_list_msg = Message.chat_list
+_buddy_msg = Message.buddy
+_CHAT_MSG = str(Message.CHAT_MSG)
+
+# time in seconds to wait for the client task to stop
+STOP_TIMEOUT = 5
+
+# minimum and maximum time in seconds to wait before reconnecting, the wait
+# time doubles after every connection attempt without a successful sync
+RECONNECT_BACKOFF_MIN = 1.0
+RECONNECT_BACKOFF_MAX = 60.0
+
+# commands that are handled while the client is offline
+OFFLINE_COMMANDS = frozenset((
+    Callback.GET_STATUS,
+    Callback.SET_STATUS,
+))
+
+# commands with coroutine handlers that must be awaited
+ASYNC_COMMANDS = frozenset((
+    Callback.CHAT_JOIN,
+    Callback.CHAT_PART,
+    Callback.CHAT_USERS,
+    Callback.CHAT_INVITE,
+))
+
+
+def _invite_event(account: "Account", room_id: str, _sender_id: str,
+                  sender_name: str, room_name: str,
+                  invited_user: str) -> Tuple[str, str]:
+    """
+    Create user and chat message for invite membership event
+    """
+
+    user_msg = _chat_user_msg(account, room_id, invited_user, invited_user,
+                              "invite")
+    msg = f"*** {sender_name} invited {invited_user} to {room_name}. ***"
+    return user_msg, msg
+
+
+def _join_event(account: "Account", room_id: str, sender_id: str,
+                _sender_name: str, room_name: str,
+                invited_user: str) -> Tuple[str, str]:
+    """
+    Create user and chat message for join membership event
+    """
+
+    user_msg = _chat_user_msg(account, room_id, sender_id, invited_user,
+                              "join")
+    msg = f"*** {invited_user} joined {room_name}. ***"
+    return user_msg, msg
+
+
+def _leave_event(account: "Account", room_id: str, sender_id: str,
+                 sender_name: str, room_name: str,
+                 _invited_user: str) -> Tuple[str, str]:
+    """
+    Create user and chat message for leave membership event
+    """
+
+    user_msg = _chat_user_msg(account, room_id, sender_id, sender_name,
+                              "leave")
+    msg = f"*** {sender_name} left {room_name}. ***"
+    return user_msg, msg
+
+
+# message builders for handled membership event types
+MEMBERSHIP_EVENTS: Dict[str, Callable[..., Tuple[str, str]]] = {
+    "invite": _invite_event,
+    "join": _join_event,
+    "leave": _leave_event,
+}
+
 
 class BackendClient:
     """
     Backend Client Class for connections to the IM network
     """
 
-    def __init__(self, account: "Account") -> None:
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, account: "Account",
+                 connect_limit: asyncio.Semaphore) -> None:
         # account
         self.account = account
 
+        # event that is set when the client connection goes offline
+        self._disconnected = asyncio.Event()
+
         # initialize matrix client connection
         self.client = MatrixClient(account,
-                                   (self._message, self._membership_event))
+                                   (self._message, self._membership_event,
+                                    self._disconnected.set, self._error),
+                                   connect_limit)
 
         # client task
         self.task: Optional[asyncio.Task] = None
@@ -39,6 +126,9 @@ class BackendClient:
         # is client active?
         self.active = True
 
+        # current time to wait before reconnecting
+        self._backoff = RECONNECT_BACKOFF_MIN
+
         # sync token and connection config
         self.settings = SimpleNamespace(
             # Send regular message to client for membership events?
@@ -47,6 +137,24 @@ class BackendClient:
             membership_user_msg=True,
         )
 
+        # cached buddy messages and rooms version they were created from
+        self._buddies: List[str] = []
+        self._buddies_version = -1
+
+        # command handlers, called with the command parameters
+        self._commands: Dict[Callback, Callable[[Tuple], Any]] = {
+            Callback.GET_BUDDIES: lambda params: self.get_buddies(params[0]),
+            Callback.SEND_MESSAGE: self._send_message,
+            Callback.SET_STATUS: lambda params: self._set_status(params[0]),
+            Callback.GET_STATUS: lambda _params: self._get_status(),
+            Callback.CHAT_LIST: lambda _params: self._chat_list(),
+            Callback.CHAT_JOIN: lambda params: self._chat_join(params[0]),
+            Callback.CHAT_PART: lambda params: self._chat_part(params[0]),
+            Callback.CHAT_USERS: lambda params: self._chat_users(params[0]),
+            Callback.CHAT_INVITE:
+            lambda params: self._chat_invite(params[0], params[1]),
+        }
+
     async def _start(self) -> None:
         """
         Start the client as a task
@@ -54,22 +162,43 @@ class BackendClient:
 
         # enter main loop
         try:
-            while True:
+            while self.active:
                 # if client is offline, (re)connect
                 if self.client.status == "offline":
                     # start client connection
                     await self.client.connect(self.account.password)
 
-                # stop, if client is inactive
-                if not self.active:
-                    return
+                # wait until client connection goes offline
+                await self._disconnected.wait()
+                self._disconnected.clear()
+
+                # reset backoff if connection was working
+                if self.client.synced:
+                    self._backoff = RECONNECT_BACKOFF_MIN
 
                 # sleep a little bit before reconnecting
-                await asyncio.sleep(15)
+                if self.active:
+                    await asyncio.sleep(self._backoff)
+                    self._backoff = min(self._backoff * 2,
+                                        RECONNECT_BACKOFF_MAX)
         except asyncio.CancelledError:
-            # close underlying http session
+            pass
+        finally:
+            await self._close()
+
+    async def _close(self) -> None:
+        """
+        Clean up client connection when the client task stops
+        """
+
+        # save latest sync token
+        await self.client.save_sync_token()
+
+        # close underlying http session
+        try:
             await self.client.client.close()
-            return
+        except Exception as error:  # pylint: disable=broad-except
+            logging.error(error)
 
     async def start(self) -> None:
         """
@@ -85,9 +214,13 @@ class BackendClient:
         """
 
         self.active = False
-        assert self.task
+        self._disconnected.set()
+        if not self.task:
+            return
+
+        # stop client task and wait for its cleanup
         self.task.cancel()
-        await self.task
+        await asyncio.wait({self.task}, timeout=STOP_TIMEOUT)
 
     def _membership_event(self, *params):
         """
@@ -99,35 +232,22 @@ class BackendClient:
             invited_user = params
 
         # check membership type
-        if event_type == "invite":
-            user_msg = Message.chat_user(self.account, room_id, invited_user,
-                                         invited_user, event_type)
-            msg = (f"*** {sender_name} invited {invited_user} "
-                   f"to {room_name}. ***")
-
-        elif event_type == "join":
-            user_msg = Message.chat_user(self.account, room_id, sender_id,
-                                         invited_user, event_type)
-            msg = f"*** {invited_user} joined {room_name}. ***"
-
-        elif event_type == "leave":
-            user_msg = Message.chat_user(self.account, room_id, sender_id,
-                                         sender_name, event_type)
-            msg = f"*** {sender_name} left {room_name}. ***"
-
-        else:
+        builder = MEMBERSHIP_EVENTS.get(event_type)
+        if builder is None:
             return
-
-        # generic event, return as message
-        # TODO: change parsing in nuqql and use char + / + sender here?
-        formatted_msg = Message.CHAT_MSG.format(self.account.aid, room_id,
-                                                tstamp, sender_id, msg)
+        account = self.account
+        user_msg, msg = builder(account, room_id, sender_id, sender_name,
+                                room_name, invited_user)
 
         # add event to event list
-        if self.settings.membership_user_msg:
-            self.account.receive_msg(user_msg)
-        if self.settings.membership_message_msg:
-            self.account.receive_msg(formatted_msg)
+        settings = self.settings
+        if settings.membership_user_msg:
+            account.receive_msg(user_msg)
+        if settings.membership_message_msg:
+            # generic event, return as message
+            # TODO: change parsing in nuqql and use char + / + sender here?
+            account.receive_msg(_CHAT_MSG.format(account.aid, room_id, tstamp,
+                                                 sender_id, msg))
 
     def _message(self, tstamp, sender, room_id, msg) -> None:
         """
@@ -135,37 +255,25 @@ class BackendClient:
         """
 
         # save timestamp and message in messages list and history
-        formatted_msg = Message.chat_msg(self.account, tstamp, sender, room_id,
-                                         msg)
-        self.account.receive_msg(formatted_msg)
-
-    def muc_message(self, msg) -> None:
-        """
-        Groupchat message handler.
-        """
-        # TODO: if we do nothing extra here, move it into normal message
-        # handler above?
+        account = self.account
+        account.receive_msg(_chat_msg(account, tstamp, sender, room_id, msg))
 
-    def _muc_presence(self, presence, status) -> None:
+    def _error(self, error: str) -> None:
         """
-        Group chat presence handler
+        Error handler
         """
 
-        # get chat and our nick in the chat
+        self.account.receive_msg(Message.error(error))
 
-    def muc_online(self, presence) -> None:
+    def _receive_msgs(self, msgs: List[str]) -> None:
         """
-        Group chat online presence handler
+        Pass multiple (non chat) messages to the account at once
         """
 
-        self._muc_presence(presence, "online")
-
-    def muc_offline(self, presence) -> None:
-        """
-        Group chat offline presence handler
-        """
-
-        self._muc_presence(presence, "offline")
+        # messages are complete lines, so they can be queued as a single
+        # message that is sent to the nuqql client in one write
+        if msgs:
+            self.account.receive_msg("".join(msgs))
 
     async def handle_command(self, cmd: Callback, params: Tuple) -> None:
         """
@@ -174,38 +282,28 @@ class BackendClient:
             command and its parameters
         """
 
-        if cmd == Callback.GET_BUDDIES:
-            self.get_buddies(params[0])
-        if cmd == Callback.SEND_MESSAGE:
-            await self._send_message(params)
-        if cmd == Callback.SET_STATUS:
-            self._set_status(params[0])
-        if cmd == Callback.GET_STATUS:
-            self._get_status()
-        if cmd == Callback.CHAT_LIST:
-            self._chat_list()
-        if cmd == Callback.CHAT_JOIN:
-            await self._chat_join(params[0])
-        if cmd == Callback.CHAT_PART:
-            await self._chat_part(params[0])
-        if cmd == Callback.CHAT_USERS:
-            await self._chat_users(params[0])
-        if cmd == Callback.CHAT_INVITE:
-            await self._chat_invite(params[0], params[1])
-
-    async def _send_message(self, message_tuple: Tuple) -> None:
+        # if we are offline, only handle status commands
+        if self.client.status == "offline" and cmd not in OFFLINE_COMMANDS:
+            return
+
+        handler = self._commands.get(cmd)
+        if handler is None:
+            return
+
+        if cmd in ASYNC_COMMANDS:
+            await handler(params)
+        else:
+            handler(params)
+
+    def _send_message(self, message_tuple: Tuple) -> None:
         """
         Send a single message
         """
 
-        # if we are offline, send nothing
-        # TODO: remove this?
-        if self.client.status == "offline":
-            return
-
-        # create message from message tuple and send it
+        # create message from message tuple and queue it for sending, so
+        # nuqql does not wait for the matrix server
         dest, msg, html_msg, _mtype = message_tuple
-        await self.client.send_message(dest, msg, html_msg)
+        self.client.queue_message(dest, msg, html_msg)
 
     def _set_status(self, status: str) -> None:
         """
@@ -229,10 +327,11 @@ class BackendClient:
         """
 
         rooms = self.client.get_rooms()
-        for room in rooms.values():
-            self.account.receive_msg(Message.chat_list(
-                self.account, room.room_id, escape_name(room.display_name),
-                self.client.get_user()))
+        user = self.client.user_id
+        self._receive_msgs([
+            _chat_list_msg(self.account, room.room_id,
+                           escape_name(room.display_name), user)
+            for room in rooms.values()])
 
     async def _chat_create(self, name: str) -> None:
         """
@@ -268,11 +367,10 @@ class BackendClient:
         """
 
         user_list = await self.client.list_room_users(chat)
-        for user in user_list:
-            user_id, user_name, user_status = user
-            self.account.receive_msg(
-                Message.chat_user(self.account, chat, user_id, user_name,
-                                  user_status))
+        self._receive_msgs([
+            _chat_user_msg(self.account, chat, user_id, user_name,
+                           user_status)
+            for user_id, user_name, user_status in user_list])
 
     async def _chat_invite(self, chat: str, user_id: str) -> None:
         """
@@ -288,39 +386,44 @@ class BackendClient:
         get roster/buddy list
         """
 
-        # if we are offline, there are no buddies
-        if self.client.status == "offline":
-            return
-
         # if only online wanted, skip because no matrix room is "online"
         if online:
             return
 
-        # get buddies/rooms
-        rooms = self.client.get_rooms()
-        for room in rooms.values():
-            name = escape_name(room.display_name)
+        # update buddy messages only if rooms changed since last time
+        version = self.client.rooms_version
+        if version != self._buddies_version:
+            self._update_buddies()
+            self._buddies_version = version
+
+        # send buddy messages
+        self._receive_msgs(self._buddies)
 
-            # use special status for group chats
-            status = "GROUP_CHAT"
+    def _update_buddies(self) -> None:
+        """
+        Update buddy messages for rooms and room invites
+        """
 
-            # send buddy message
-            msg = Message.buddy(self.account, room.room_id, name, status)
-            self.account.receive_msg(msg)
+        # reuse buddy message list
+        buddies = self._buddies
+        buddies.clear()
+
+        # get buddies/rooms, use special status for group chats
+        rooms = self.client.get_rooms()
+        buddies.extend(_buddy_msg(self.account, room.room_id,
+                                  escape_name(room.display_name),
+                                  "GROUP_CHAT")
+                       for room in rooms.values())
 
         # handle pending room invites as temporary buddies
         invites = self.client.get_invites()
-        for invite in invites.values():
-            status = "GROUP_CHAT_INVITE"
-
-            # send buddy message
-            msg = Message.buddy(self.account, invite.room_id,
-                                invite.display_name, status)
-            self.account.receive_msg(msg)
+        buddies.extend(_buddy_msg(self.account, invite.room_id,
+                                  invite.display_name, "GROUP_CHAT_INVITE")
+                       for invite in invites.values())
 
-    def del_account(self):
+    async def del_account(self) -> None:
         """
         Cleanup after account deletion
         """
 
-        self.client.delete_sync_token()
+        await self.client.delete_sync_token()
@@ -6,6 +6,12 @@ matrixd main entry point
 
 import asyncio
 
+try:
+    import uvloop  # type: ignore
+    HAVE_UVLOOP = True
+except ImportError:
+    HAVE_UVLOOP = False
+
 from nuqql_matrixd_nio.server import BackendServer
 
 
@@ -23,6 +29,10 @@ def main() -> None:
     Main entry point
     """
 
+    # use faster uvloop event loop if available
+    if HAVE_UVLOOP:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     try:
         asyncio.run(_main())
     except KeyboardInterrupt:
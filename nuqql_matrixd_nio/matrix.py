@@ -2,13 +2,17 @@
 matrix specific stuff
 """
 
-import json
+import asyncio
+import functools
 import logging
 import os
 import stat
+import time
 import urllib.parse
 
-from typing import Callable, Dict, List, Tuple, TYPE_CHECKING
+from collections import OrderedDict, deque
+from typing import (Callable, Deque, Dict, List, Optional, Tuple,
+                    TYPE_CHECKING)
 
 from nio import (  # type: ignore
     AsyncClient,
@@ -27,7 +31,6 @@ from nio import (  # type: ignore
     RoomEncryptedAudio,
     RoomEncryptedFile,
     RoomEncryptedImage,
-    RoomEncryptedMedia,
     RoomEncryptedVideo,
     RoomInviteError,
     RoomLeaveError,
@@ -38,11 +41,24 @@ from nio import (  # type: ignore
     RoomMessageFile,
     RoomMessageFormatted,
     RoomMessageImage,
-    RoomMessageMedia,
     RoomMessageNotice,
     RoomMessageText,
     RoomMessageUnknown,
     RoomMessageVideo,
+    RoomSendError,
+    SyncError,
+    SyncResponse,
+)
+
+# matrixd imports
+from nuqql_matrixd_nio.storage import (
+    cache_store,
+    delete_sync_token_file,
+    json_dumps,
+    read_credentials_file,
+    read_sync_token_file,
+    write_credentials_file,
+    write_sync_token_file,
 )
 
 if TYPE_CHECKING:   # imports for typing
@@ -52,55 +68,142 @@ if TYPE_CHECKING:   # imports for typing
 STORE_DIR_SUFFIX = "_store"
 CREDENTIALS_FILE_SUFFIX = "_credentials.json"
 
+# minimum time in seconds between two writes of the sync token file
+SYNC_TOKEN_WRITE_INTERVAL = 2.0
+
+# membership types of events that name the invited or joined user
+INVITED_MEMBERSHIPS = frozenset(("invite", "join"))
+
+# maximum time in seconds a client blocks other clients from connecting
+CONNECT_LIMIT_TIMEOUT = 60.0
+
+# maximum number of cached http urls of media
+MXC_CACHE_SIZE = 512
+
+# maximum number of cached profile display names of users
+PROFILE_NAME_CACHE_SIZE = 1024
+
+# (e2ee) media message types and the kind of media they contain
+MEDIA_KINDS: Dict[type, str] = {
+    RoomEncryptedAudio: "audio",
+    RoomMessageAudio: "audio",
+    RoomEncryptedFile: "file",
+    RoomMessageFile: "file",
+    RoomEncryptedImage: "image",
+    RoomMessageImage: "image",
+    RoomEncryptedVideo: "video",
+    RoomMessageVideo: "video",
+}
+
+# formatters for other handled message types
+MESSAGE_FORMATTERS: Dict[type, Callable[[RoomMessage], str]] = {
+    RoomMessageEmote: lambda event: f"*** posted emote: {event.body} ***",
+    RoomMessageFormatted: lambda event: event.body,
+    RoomMessageNotice: lambda event: event.body,
+    RoomMessageText: lambda event: event.body,
+    RoomMessageUnknown: lambda event: "*** sent room message of unknown "
+                                      f"type: {event.msgtype} ***",
+}
+
 
 class MatrixClient:
     """
     Matrix client class
     """
 
-    def __init__(self, account: "Account",
-                 handlers: Tuple[Callable, ...]) -> None:
+    # pylint: disable=too-many-instance-attributes,too-many-public-methods
+
+    def __init__(self, account: "Account", handlers: Tuple[Callable, ...],
+                 connect_limit: asyncio.Semaphore) -> None:
         self.account = account
-        store_path = self._get_path() + STORE_DIR_SUFFIX
-        if not os.path.isdir(store_path):
-            os.mkdir(store_path)
+
+        # limit for concurrent connection attempts of all clients, held from
+        # login until the first sync response or at most until a timeout
+        self._connect_limit = connect_limit
+        self._connecting = False
+        self._connect_timer: Optional[asyncio.TimerHandle] = None
+
+        # matrix server url and user id from account user
+        self._url, user, domain = parse_account_user(account.user)
+        self.user_id = f"@{user}:{domain}"
+
+        # filter own messages sent from this client?
+        self._filter_own = account.config.get_filter_own()
+
+        # make sure config directory exists and only user can access it
+        config_dir = self.account.config.get_dir()
+        config_dir.mkdir(mode=stat.S_IRWXU, parents=True, exist_ok=True)
+        if stat.S_IMODE(config_dir.stat().st_mode) != stat.S_IRWXU:
+            os.chmod(config_dir, stat.S_IRWXU)
+        self._sync_token_file = config_dir / f"sync_token{account.aid}"
+
+        # credentials file and store directory
+        path = self._get_path()
+        self._credentials_file = path + CREDENTIALS_FILE_SUFFIX
+        store_path = path + STORE_DIR_SUFFIX
+        os.makedirs(store_path, exist_ok=True)
         config = AsyncClientConfig(
             store_sync_tokens=True,
             encryption_enabled=True,
         )
-        self.client = AsyncClient(self._get_url(), self.get_user(),
+        self.client = AsyncClient(self._url, self.user_id,
                                   store_path=store_path,
                                   config=config,
                                   )
         self.client.add_event_callback(self.message_callback, RoomMessage)
         self.client.add_event_callback(self.member_callback, RoomMemberEvent)
         self.client.add_event_callback(self.call_callback, CallEvent)
+        self.client.add_response_callback(self.sync_callback, SyncResponse)
+        self.client.add_response_callback(self.sync_error_callback,
+                                          SyncError)
         self.status = "offline"
 
+        # version of rooms and invites, changes when a sync updates them
+        self.rooms_version = 0
+
+        # joined rooms indexed by display name and room id, and the rooms
+        # version the index was created from
+        self._room_index: Dict[str, List[MatrixRoom]] = {}
+        self._room_index_version = -1
+
+        # cached login credentials, read from file on first use
+        self._credentials: Optional[Tuple[str, str, str]] = None
+
+        # cached http urls of media, in least recently used order
+        self._mxc_cache: "OrderedDict[str, str]" = OrderedDict()
+
+        # cached profile display names of users, in least recently used order
+        self._profile_name_cache: "OrderedDict[str, str]" = OrderedDict()
+
+        # did the client receive a sync response since connecting?
+        self.synced = False
+
         # handlers
-        message_handler, membership_handler = handlers
+        message_handler, membership_handler, offline_handler, error_handler = \
+            handlers
         self.message_handler = message_handler
         self.membership_handler = membership_handler
+        self.offline_handler = offline_handler
+        self.error_handler = error_handler
 
-        # load sync token
-        self.sync_token = self._load_sync_token()
-
-    def get_user(self) -> str:
-        """
-        Get matrix user id
-        """
+        # sync token, loaded from file when connecting
+        self.sync_token = ""
+        self._last_written_token = ""
+        self._last_write_ts = 0.0
+        self._sync_token_lock = asyncio.Lock()
+        self._sync_token_task: Optional[asyncio.Task] = None
 
-        _url, user, domain = parse_account_user(self.account.user)
-        username = f"@{user}:{domain}"
-        return username
+        # queued outgoing messages, sent in order in the send task, and event
+        # that is set when messages are queued
+        self._outgoing: Deque[Tuple[str, str, Optional[str]]] = deque()
+        self._outgoing_ready = asyncio.Event()
 
     def _get_url(self) -> str:
         """
         Get matrix server url
         """
 
-        url, _user, _domain = parse_account_user(self.account.user)
-        return url
+        return self._url
 
     def _get_path(self) -> str:
         """
@@ -116,80 +219,92 @@ class MatrixClient:
         Message handler
         """
 
-        # update sync token
-        self._update_sync_token()
-
-        # if filter own is set, skip own messages
-        if self.account.config.get_filter_own() and \
-           event.sender == self.get_user():
-            if event.transaction_id:
+        sender = event.sender
+        if sender == self.user_id:
+            # if filter own is set, skip own messages
+            if self._filter_own and event.transaction_id:
                 # only events from this client/device have a transaction ID;
                 # only filter these messages, so we still get our own messages
                 # from our other devices
                 return
 
-        # rewrite sender of own messages
-        sender = event.sender
-        if event.sender == self.get_user():
+            # rewrite sender of own messages
             sender = "<self>"
 
-        # all (e2ee) media
-        if isinstance(event, (RoomMessageMedia, RoomEncryptedMedia)):
-            media_mxc = event.url
-            media_url = await self.client.mxc_to_http(media_mxc)
-            msg_url = " [" + media_url + "]"
-
         # handle media/message types
-        if isinstance(event, (RoomEncryptedAudio, RoomMessageAudio)):
-            msg = "*** posted audio: " + event.body + msg_url + " ***"
-        elif isinstance(event, RoomMessageEmote):
-            msg = "*** posted emote: " + event.body + " ***"
-        elif isinstance(event, (RoomEncryptedFile, RoomMessageFile)):
-            msg = "*** posted file: " + event.body + msg_url + " ***"
-        elif isinstance(event, (RoomMessageFormatted, RoomMessageNotice,
-                                RoomMessageText)):
-            msg = event.body
-        elif isinstance(event, (RoomEncryptedImage, RoomMessageImage)):
-            # Usually body is something like "image.svg"
-            msg = "*** posted image: " + event.body + msg_url + " ***"
-        elif isinstance(event, RoomMessageUnknown):
-            msg = "*** sent room message of unknown type: " + event.msgtype + \
-                    " ***"
-        elif isinstance(event, (RoomEncryptedVideo, RoomMessageVideo)):
-            msg = "*** posted video: " + event.body + msg_url + " ***"
+        kind, formatter = _resolve_message_type(event.__class__)
+
+        if kind is not None:
+            # all (e2ee) media, body is usually something like "image.svg"
+            media_url = await self._get_media_url(event.url)
+            msg = f"*** posted {kind}: {event.body} [{media_url}] ***"
+        elif formatter is not None:
+            msg = formatter(event)
         else:
             # unhandled message
             return
 
         # save timestamp and message in messages list and history
-        tstamp = str(int(event.server_timestamp/1000))
+        tstamp = str(event.server_timestamp // 1000)
         self.message_handler(tstamp, sender, room.machine_name, msg)
 
+    async def _get_media_url(self, mxc: str) -> str:
+        """
+        Get http url of media with mxc url, use cached url if available
+        """
+
+        cache = self._mxc_cache
+        url = cache.get(mxc)
+        if url is not None:
+            cache.move_to_end(mxc)
+            return url
+
+        url = await self.client.mxc_to_http(mxc)
+        cache_store(cache, mxc, url, MXC_CACHE_SIZE)
+        return url
+
+    async def _get_profile_name(self, user: str) -> str:
+        """
+        Get display name in the profile of user, use cached name if available
+        """
+
+        cache = self._profile_name_cache
+        name = cache.get(user)
+        if name is not None:
+            cache.move_to_end(user)
+            return name
+
+        resp = await self.client.get_displayname(user)
+        if not isinstance(resp, ProfileGetDisplayNameResponse):
+            return ""
+        name = resp.displayname or ""
+        cache_store(cache, user, name, PROFILE_NAME_CACHE_SIZE)
+        return name
+
     async def member_callback(self, room: MatrixRoom,
                               event: RoomMemberEvent) -> None:
         """
         Room membership event handler
         """
 
-        tstamp = str(int(event.server_timestamp/1000))
+        tstamp = str(event.server_timestamp // 1000)
 
-        # update sync token
-        self._update_sync_token()
+        # membership events other than leave can change the display name
+        # of their user, forget the cached profile name of the user
+        if event.membership != "leave":
+            self._profile_name_cache.pop(event.state_key, None)
 
         # set display name of user
         display_name = room.user_name(event.sender)
         if event.membership == "leave":
-            resp = await self.client.get_displayname(event.sender)
-            if isinstance(resp, ProfileGetDisplayNameResponse):
-                if resp.displayname:
-                    display_name = resp.displayname
+            profile_name = await self._get_profile_name(event.sender)
+            if profile_name:
+                display_name = profile_name
 
         # set invited user
         invited_user = ""
-        if event.membership == "invite":
-            invited_user = event.content["displayname"]
-        if event.membership == "join":
-            invited_user = event.content["displayname"]
+        if event.membership in INVITED_MEMBERSHIPS:
+            invited_user = event.content.get("displayname", "")
 
         self.membership_handler(event.membership, tstamp, event.sender,
                                 display_name, room.room_id, room.display_name,
@@ -200,78 +315,102 @@ class MatrixClient:
         Call event handler
         """
 
-        # update sync token
-        self._update_sync_token()
-
-        # if filter own is set, skip own messages
-        if self.account.config.get_filter_own() and \
-           event.sender == self.get_user():
-            if event.transaction_id:
+        sender = event.sender
+        if sender == self.user_id:
+            # if filter own is set, skip own messages
+            if self._filter_own and event.transaction_id:
                 # only events from this client/device have a transaction ID;
                 # only filter these messages, so we still get our own messages
                 # from our other devices
                 return
 
-        # rewrite sender of own messages
-        sender = event.sender
-        if event.sender == self.get_user():
+            # rewrite sender of own messages
             sender = "<self>"
 
         # call event types
         if isinstance(event, CallInviteEvent):
-            msg = "*** invited to call " + event.call_id + " ***"
+            msg = f"*** invited to call {event.call_id} ***"
         elif isinstance(event, CallAnswerEvent):
-            msg = "*** answered call " + event.call_id + " ***"
+            msg = f"*** answered call {event.call_id} ***"
         elif isinstance(event, CallHangupEvent):
-            msg = "*** hung up call " + event.call_id + " ***"
+            msg = f"*** hung up call {event.call_id} ***"
         else:
             # unhandled message
             return
 
         # save timestamp and message in messages list and history
-        tstamp = str(int(event.server_timestamp/1000))
+        tstamp = str(event.server_timestamp // 1000)
         self.message_handler(tstamp, sender, room.machine_name, msg)
 
-    def save_credentials(self, user_id: str, device_id: str,
-                         access_token: str) -> None:
+    async def sync_callback(self, response: SyncResponse) -> None:
+        """
+        Sync response handler
+        """
+
+        self.synced = True
+        self._connected()
+        if _rooms_changed(response):
+            self.rooms_version += 1
+
+        # update sync token
+        self._update_sync_token()
+
+    async def sync_error_callback(self, _response: SyncError) -> None:
+        """
+        Sync error response handler
+        """
+
+        # the connection attempt is over, even if it failed
+        self._connected()
+
+    async def save_credentials(self, user_id: str, device_id: str,
+                               access_token: str) -> None:
         """
         save credentials like access token to disk for later logins
         """
 
-        # open the config file in write-mode
-        path = self._get_path() + CREDENTIALS_FILE_SUFFIX
-        with open(path, "w", encoding='UTF-8') as cred_file:
-            # write the login details to disk
-            json.dump({
-                "homeserver": self._get_url(),  # e.g. "https://matrix.x.org"
-                "user_id": user_id,  # e.g. "@user:example.org"
-                "device_id": device_id,  # device ID, 10 uppercase letters
-                "access_token": access_token  # cryptogr. access token
-                }, cred_file)
+        # serialize the login details
+        data = json_dumps({
+            "homeserver": self._get_url(),  # e.g. "https://matrix.x.org"
+            "user_id": user_id,  # e.g. "@user:example.org"
+            "device_id": device_id,  # device ID, 10 uppercase letters
+            "access_token": access_token  # cryptogr. access token
+            })
 
-    def get_credentials(self) -> Tuple[str, str, str]:
+        # write file in executor to avoid blocking the event loop
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write_credentials_file,
+                                   self._credentials_file, data)
+        self._credentials = (user_id, device_id, access_token)
+
+    async def get_credentials(self) -> Tuple[str, str, str]:
         """
         read previously saved credentials from disk
         """
 
-        credentials_file = self._get_path() + CREDENTIALS_FILE_SUFFIX
-        if os.path.exists(credentials_file):
-            with open(credentials_file, "r", encoding='UTF-8') as cred_file:
-                creds = json.load(cred_file)
-                return (creds["user_id"], creds["device_id"],
-                        creds["access_token"])
-        return ("", "", "")
+        if self._credentials is None:
+            # read file in executor to avoid blocking the event loop
+            loop = asyncio.get_running_loop()
+            self._credentials = await loop.run_in_executor(
+                None, read_credentials_file, self._credentials_file)
+        return self._credentials
 
     async def sync_task(self) -> None:
         """
         Start sync forever task
         """
 
+        # without a previous sync token, skip the old messages in the first
+        # sync and only get the current state of the rooms
+        first_sync_filter: Dict = {}
+        if not self.sync_token:
+            first_sync_filter = {"room": {"timeline": {"limit": 0}}}
+
         try:
             await self.client.sync_forever(
                 timeout=30000,
                 sync_filter={},
-                first_sync_filter={},
+                first_sync_filter=first_sync_filter,
                 since=self.sync_token,
                 full_state=True,
             )
@@ -279,18 +418,60 @@ class MatrixClient:
             logging.error("unhandled exception in sync_forever()")
             logging.error(error)
 
+        # save latest sync token
+        await self.save_sync_token()
+
         # if sync_forever() terminates, something went wrong and we are
         # probably offline. Set status to offline and trigger reconnect
         logging.error("sync task stopped")
-        self.status = "offline"
+        self.set_offline()
 
     async def connect(self, password: str) -> str:
         """
         Connect to matrix server
         """
 
+        self.synced = False
+        self._mxc_cache.clear()
+        self._profile_name_cache.clear()
+
+        # wait until fewer clients are connecting
+        await self._connect_limit.acquire()
+        self._connecting = True
+
+        # do not block other clients forever if the server does not respond
+        loop = asyncio.get_running_loop()
+        self._connect_timer = loop.call_later(CONNECT_LIMIT_TIMEOUT,
+                                              self._connected)
+        try:
+            return await self._connect(password)
+        finally:
+            self._connected()
+
+    def _connected(self) -> None:
+        """
+        Allow other clients to connect after this client's connection attempt
+        """
+
+        if self._connecting:
+            self._connecting = False
+            self._connect_limit.release()
+        if self._connect_timer:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+
+    async def _connect(self, password: str) -> str:
+        """
+        Log in and run sync task
+        """
+
+        # load sync token
+        if not self.sync_token:
+            self.sync_token = await self._load_sync_token()
+            self._last_written_token = self.sync_token
+
         # try to restore previous login
-        user_id, device_id, access_token = self.get_credentials()
+        user_id, device_id, access_token = await self.get_credentials()
         if access_token != "":
             self.client.restore_login(
                 user_id=user_id,
@@ -305,15 +486,19 @@ class MatrixClient:
                 self.status = "online"
 
                 # save credentials
-                self.save_credentials(resp.user_id, resp.device_id,
-                                      resp.access_token)
+                await self.save_credentials(resp.user_id, resp.device_id,
+                                            resp.access_token)
+            else:
+                # login failed, trigger reconnect
+                self.set_offline()
 
         if self.status == "online":
-            # start sync task
-            sync_filter = {"room": {"timeline": {"limit": 0}}}
-            await self.client.sync(timeout=30000, full_state=True,
-                                   sync_filter=sync_filter)
-            await self.sync_task()
+            # start send and sync task
+            send_task = asyncio.create_task(self._send_task())
+            try:
+                await self.sync_task()
+            finally:
+                send_task.cancel()
 
             # close underlying http session
             await self.client.close()
@@ -325,6 +510,14 @@ class MatrixClient:
         Stop client
         """
 
+    def set_offline(self) -> None:
+        """
+        Set status to offline and notify offline handler
+        """
+
+        self.status = "offline"
+        self.offline_handler()
+
     def _get_sync_token(self) -> str:
         """
         Get sync token of client connection
@@ -346,6 +539,31 @@ class MatrixClient:
 
         return self.client.invited_rooms
 
+    def _find_rooms(self, room_name: str) -> List[MatrixRoom]:
+        """
+        Find joined rooms with room_name as display name or room id
+        """
+
+        # update room index only if rooms changed since last time
+        version = self.rooms_version
+        if version != self._room_index_version:
+            self._update_room_index()
+            self._room_index_version = version
+
+        return self._room_index.get(room_name, [])
+
+    def _update_room_index(self) -> None:
+        """
+        Update index of joined rooms by display name and room id
+        """
+
+        index: Dict[str, List[MatrixRoom]] = {}
+        for room in self.get_rooms().values():
+            index.setdefault(room.display_name, []).append(room)
+            if room.room_id != room.display_name:
+                index.setdefault(room.room_id, []).append(room)
+        self._room_index = index
+
     @staticmethod
     def get_display_name(user: str) -> str:
         """
@@ -354,30 +572,80 @@ class MatrixClient:
 
         return user
 
+    def queue_message(self, dest_room: str, msg: str,
+                      html_msg: Optional[str]) -> None:
+        """
+        Queue msg for dest_room, it is sent in the send task
+        """
+
+        self._outgoing.append((dest_room, msg, html_msg))
+        self._outgoing_ready.set()
+
+    async def _send_task(self) -> None:
+        """
+        Send queued messages one after the other
+        """
+
+        # a message is only removed from the queue when sending it is done, so
+        # a message interrupted by a disconnect is sent again after reconnect
+        outgoing = self._outgoing
+        ready = self._outgoing_ready
+        while True:
+            if not outgoing:
+                ready.clear()
+                await ready.wait()
+                continue
+
+            dest_room, msg, html_msg = outgoing[0]
+            try:
+                error = await self.send_message(dest_room, msg, html_msg)
+            except Exception as exc:  # pylint: disable=broad-except
+                error = str(exc)
+            outgoing.popleft()
+            if error != "":
+                self.error_handler(error)
+
     async def send_message(self, dest_room: str, msg: str,
-                           html_msg: str) -> None:
+                           html_msg: Optional[str]) -> str:
         """
         Send msg to dest_room
         """
 
-        rooms = self.get_rooms()
-        for room in rooms.values():
-            if dest_room in (room.display_name, room.room_id):
-                try:
-                    await self.client.room_send(
-                        room_id=room.room_id,
-                        message_type="m.room.message",
-                        content={
-                            "msgtype": "m.text",
-                            "format": "org.matrix.custom.html",
-                            "formatted_body": html_msg,
-                            "body": msg,
-                        },
-                        ignore_unverified_devices=True,
-                    )
-                except LocalProtocolError as error:
-                    logging.error(error)
-                    self.status = "offline"
+        # look up room by room id directly, otherwise by display name; unlike
+        # invite_room() and list_room_users(), only send the message to the
+        # first matching room
+        room_id = dest_room
+        if room_id not in self.get_rooms():
+            rooms = self._find_rooms(dest_room)
+            if not rooms:
+                return ""
+            room_id = rooms[0].room_id
+
+        # only add formatted version of message if there is one
+        if html_msg is None:
+            content = {"msgtype": "m.text", "body": msg}
+        else:
+            content = {
+                "msgtype": "m.text",
+                "format": "org.matrix.custom.html",
+                "formatted_body": html_msg,
+                "body": msg,
+            }
+
+        try:
+            resp = await self.client.room_send(
+                room_id=room_id,
+                message_type="m.room.message",
+                content=content,
+                ignore_unverified_devices=True,
+            )
+        except LocalProtocolError as error:
+            logging.error(error)
+            self.set_offline()
+            return str(error)
+        if isinstance(resp, RoomSendError):
+            return str(resp)
+        return ""
 
     async def create_room(self, room_name: str) -> str:
         """
@@ -404,36 +672,28 @@ class MatrixClient:
             return str(resp)
         return ""
 
-    async def _part_room(self, rooms: Dict[str, MatrixRoom],
-                         room_name: str) -> str:
-        # if room_name is in the rooms dictionary, try to leave/reject it
-        for room in rooms.values():
-            if unescape_name(room_name) == room.display_name or \
-               unescape_name(room_name) == room.room_id:
-                # leave room
-                resp = await self.client.room_leave(room.room_id)
-                if isinstance(resp, RoomLeaveError):
-                    return str(resp)
-                return ""
-        return "NOT FOUND"
-
     async def part_room(self, room_name: str) -> str:
         """
         Leave chat room identified by room_name
         """
 
-        # part an already joined room
-        rooms = self.get_rooms()
-        resp = await self._part_room(rooms, room_name)
-        if resp == "" or resp != "NOT FOUND":
-            return resp
-
-        # part a room we are invited to
-        rooms = self.get_invites()
-        resp = await self._part_room(rooms, room_name)
-        if resp == "NOT FOUND":
+        # find an already joined room or a room we are invited to
+        name = unescape_name(room_name)
+        joined = self._find_rooms(name)
+        if joined:
+            room: Optional[MatrixRoom] = joined[0]
+        else:
+            room = next((invite for invite in self.get_invites().values()
+                         if name in (invite.display_name, invite.room_id)),
+                        None)
+        if room is None:
             return f"room {room_name} not found"
-        return resp
+
+        # leave/reject room
+        resp = await self.client.room_leave(room.room_id)
+        if isinstance(resp, RoomLeaveError):
+            return str(resp)
+        return ""
 
     async def list_room_users(self, room_name: str) -> List[Tuple[str, str,
                                                                   str]]:
@@ -441,19 +701,20 @@ class MatrixClient:
         List users in room identified by room_name
         """
 
-        rooms = self.get_rooms()
+        # get members of all matching rooms concurrently
+        rooms = self._find_rooms(unescape_name(room_name))
+        resps = await asyncio.gather(*[
+            self.client.joined_members(room.room_id) for room in rooms])
+
         user_list: List[Tuple[str, str, str]] = []
-        for room in rooms.values():
-            if unescape_name(room_name) == room.display_name or \
-               unescape_name(room_name) == room.room_id:
-                # list members
-                resp = await self.client.joined_members(room.room_id)
-                if not isinstance(resp, JoinedMembersResponse):
-                    return user_list
-                for member in resp.members:
-                    user_list.append((member.user_id,
-                                      escape_name(member.display_name),
-                                      "join"))
+        for resp in resps:
+            # list members
+            if not isinstance(resp, JoinedMembersResponse):
+                return user_list
+            for member in resp.members:
+                user_list.append((member.user_id,
+                                  escape_name(member.display_name),
+                                  "join"))
 
         return user_list
 
@@ -462,39 +723,20 @@ class MatrixClient:
         Invite user with user_id to room with room_name
         """
 
-        rooms = self.get_rooms()
-        for room in rooms.values():
-            if unescape_name(room_name) == room.display_name or \
-               unescape_name(room_name) == room.room_id:
-                resp = await self.client.room_invite(room.room_id, user_id)
-                if isinstance(resp, RoomInviteError):
-                    return str(resp)
+        for room in self._find_rooms(unescape_name(room_name)):
+            resp = await self.client.room_invite(room.room_id, user_id)
+            if isinstance(resp, RoomInviteError):
+                return str(resp)
         return ""
 
-    def _load_sync_token(self) -> str:
+    async def _load_sync_token(self) -> str:
         """
         Load an old sync token from file if available
         """
 
-        # make sure path and file exist
-        acc_id = self.account.aid
-        self.account.config.get_dir().mkdir(parents=True, exist_ok=True)
-        os.chmod(self.account.config.get_dir(), stat.S_IRWXU)
-        sync_token_file = self.account.config.get_dir() / f"sync_token{acc_id}"
-        if not sync_token_file.exists():
-            with open(sync_token_file, "a", encoding='UTF-8'):
-                pass
-
-        # make sure only user can read/write file before using it
-        os.chmod(sync_token_file, stat.S_IRUSR | stat.S_IWUSR)
-
-        try:
-            with open(sync_token_file, "r", encoding='UTF-8') as token_file:
-                token = token_file.readline()
-        except OSError:
-            token = ""
-
-        return token
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, read_sync_token_file,
+                                          self._sync_token_file)
 
     def _update_sync_token(self) -> None:
         """
@@ -509,30 +751,100 @@ class MatrixClient:
             return
         self.sync_token = new
 
-        # update token file
-        acc_id = self.account.aid
-        sync_token_file = self.account.config.get_dir() / f"sync_token{acc_id}"
+        # save token in a separate task, unless one is already pending and
+        # will save the latest token
+        task = self._sync_token_task
+        if task is None or task.done():
+            self._sync_token_task = asyncio.create_task(
+                self._save_sync_token_task())
 
-        try:
-            with open(sync_token_file, "w", encoding='UTF-8') as token_file:
-                token_file.write(new)
-        except OSError:
-            return
+    async def _save_sync_token_task(self) -> None:
+        """
+        Save sync token, but not more often than once per write interval
+        """
 
-    def delete_sync_token(self) -> None:
+        delay = self._last_write_ts + SYNC_TOKEN_WRITE_INTERVAL - \
+            time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.save_sync_token()
+
+    async def save_sync_token(self) -> None:
+        """
+        Save the current sync token to the token file if it changed
+        """
+
+        async with self._sync_token_lock:
+            token = self.sync_token
+            if token == self._last_written_token:
+                return
+
+            # write file in executor to avoid blocking the event loop
+            self._last_write_ts = time.monotonic()
+            loop = asyncio.get_running_loop()
+            if await loop.run_in_executor(None, write_sync_token_file,
+                                          self._sync_token_file, token):
+                self._last_written_token = token
+
+    async def delete_sync_token(self) -> None:
         """
         Delete the sync token file for the account, called when account is
         removed
         """
 
-        acc_id = self.account.aid
-        sync_token_file = self.account.config.get_dir() / f"sync_token{acc_id}"
-        if not sync_token_file.exists():
-            return
+        # do not save sync token anymore
+        if self._sync_token_task:
+            self._sync_token_task.cancel()
+
+        async with self._sync_token_lock:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, delete_sync_token_file,
+                                       self._sync_token_file)
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_message_type(
+        event_type: type) -> Tuple[Optional[str],
+                                   Optional[Callable[[RoomMessage], str]]]:
+    """
+    Get media kind or message formatter of event_type or of its closest
+    handled base class, (None, None) if event_type is not handled
+    """
 
-        os.remove(sync_token_file)
+    mro = event_type.__mro__
+    for base in mro:
+        kind = MEDIA_KINDS.get(base)
+        if kind is not None:
+            return kind, None
+    for base in mro:
+        formatter = MESSAGE_FORMATTERS.get(base)
+        if formatter is not None:
+            return None, formatter
+    return None, None
 
 
+def _rooms_changed(response: SyncResponse) -> bool:
+    """
+    Check if sync response changes rooms or room invites, i.e., contains
+    invited, left or joined rooms with state events
+    """
+
+    rooms = response.rooms
+    if rooms.invite or rooms.leave:
+        return True
+
+    for info in rooms.join.values():
+        if info.state:
+            return True
+        for event in info.timeline.events:
+            # state events in the timeline have a state key
+            if "state_key" in event.source:
+                return True
+
+    return False
+
+
+@functools.lru_cache(maxsize=4096)
 def escape_name(name: str) -> str:
     """
     Escape "invalid" charecters in name, e.g., space.
@@ -542,6 +854,7 @@ def escape_name(name: str) -> str:
     return urllib.parse.quote(name)
 
 
+@functools.lru_cache(maxsize=1024)
 def unescape_name(name: str) -> str:
     """
     Convert name back to unescaped version.
@@ -560,20 +873,20 @@ def parse_account_user(acc_user: str) -> Tuple[str, str, str]:
     # get user name and homeserver part from account user
     user, homeserver = acc_user.split("@", maxsplit=1)
 
-    if homeserver.startswith("http://") or homeserver.startswith("https://"):
+    if homeserver.startswith(("http://", "https://")):
         # assume homeserver part contains url
         url = homeserver
 
-        # extract domain name, strip http(s) from homeserver name
-        domain = homeserver.split("//", maxsplit=1)[1]
-
-        # strip port from remaining domain name
-        domain = domain.split(":", maxsplit=1)[0]
+        # extract domain name without http(s) and port from homeserver url,
+        # keep its case and the brackets of ipv6 addresses
+        domain = urllib.parse.urlsplit(homeserver).netloc
+        if ":" in domain and not domain.endswith("]"):
+            domain = domain.rsplit(":", maxsplit=1)[0]
     else:
         # assume homeserver part only contains the domain
         domain = homeserver
 
         # construct url, default to https
-        url = "https://" + domain
+        url = f"https://{domain}"
 
     return url, user, domain
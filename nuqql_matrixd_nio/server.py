@@ -2,14 +2,17 @@
 matrixd backend server
 """
 
+import asyncio
+import configparser
 import html
 import re
 
-from typing import TYPE_CHECKING, Dict, Optional, Tuple
+from typing import TYPE_CHECKING, ClassVar, Dict, Optional, Tuple
 
 # nuqql-based imports
 from nuqql_based.based import Based
 from nuqql_based.callback import Callback
+from nuqql_based.config import Config
 from nuqql_based.message import Message
 
 # matrixd imports
@@ -25,6 +28,121 @@ if TYPE_CHECKING:   # imports for typing
 # matrixd version
 VERSION = "0.4.0"
 
+# maximum number of clients logging in and running their initial sync at the
+# same time, can be changed with the "max-connects" option in the config file
+MAX_CONCURRENT_CONNECTS = 4
+
+# section of matrixd specific options in the config file
+CONFIG_SECTION = "matrixd"
+
+# line breaks in html-escaped messages from nuqql
+BR_RE = re.compile("<br/>", re.IGNORECASE)
+
+# character references created by html.escape() in nuqql, "&amp;" last so
+# other references are not unescaped twice
+SIMPLE_ESCAPES = (
+    ("&lt;", "<"),
+    ("&gt;", ">"),
+    ("&quot;", '"'),
+    ("&#x27;", "'"),
+    ("&amp;", "&"),
+)
+
+# any other character reference
+OTHER_ESCAPE_RE = re.compile(r"&(?!(?:amp|lt|gt|quot|#x27);)")
+
+# start and end of xhtml message bodies
+BODY_PREFIX = '<body xmlns="http://www.w3.org/1999/xhtml">'
+BODY_SUFFIX = "</body>"
+
+
+def _unescape(msg: str) -> str:
+    """
+    Unescape html-escaped message, replace common character references
+    directly and leave all others to html.unescape()
+    """
+
+    if OTHER_ESCAPE_RE.search(msg) is not None:
+        return html.unescape(msg)
+    for escaped, char in SIMPLE_ESCAPES:
+        msg = msg.replace(escaped, char)
+    return msg
+
+
+def _prepare_body(msg: str) -> Tuple[str, Optional[str]]:
+    """
+    Create plain-text and xhtml message bodies from html-escaped message
+    """
+
+    # without escaped characters or tags, both versions are the same and
+    # only the plain-text version is needed
+    if "&" not in msg and "<" not in msg:
+        return msg, None
+    html_msg = f"{BODY_PREFIX}{msg}{BODY_SUFFIX}"
+    if "&" in msg:
+        msg = _unescape(msg)
+    if "<" in msg:
+        msg = "\n".join(BR_RE.split(msg))
+    return msg, html_msg
+
+
+# static help messages
+ACCOUNT_ADD_HELP = (
+    Message.info("You do not have any accounts configured.") +
+    Message.info("You can add a new matrix account with the following "
+                 "command: account add matrix <username>@<homeserver> "
+                 "<password>") +
+    Message.info("Example: account add matrix dummy@matrix.org MyPassword"))
+WELCOME_HELP = (
+    Message.info(f"Welcome to nuqql-matrixd-nio v{VERSION}!") +
+    Message.info("Enter \"help\" for a list of available commands and their "
+                 "help texts"))
+WELCOME_ACCOUNTS_HELP = Message.info("Listing your accounts:")
+
+
+class MatrixdConfig(Config):
+    """
+    Based configuration with matrixd specific options
+    """
+
+    def __init__(self, backend_name: str, backend_version: str,
+                 max_connects: int) -> None:
+        super().__init__(backend_name, backend_version)
+        self._max_connects = max_connects
+
+    def read_from_file(self) -> None:
+        """
+        Read configuration file into config, including matrixd options
+        """
+
+        # the config file can set another directory, so remember the file
+        # based reads
+        config_file = self.get_dir() / "config.ini"
+        super().read_from_file()
+        if not config_file.exists():
+            return
+
+        # read matrixd options
+        try:
+            config = configparser.ConfigParser()
+            config.read(config_file)
+            max_connects = config.getint(CONFIG_SECTION, "max-connects",
+                                         fallback=self._max_connects)
+        except (configparser.Error, ValueError) as error:
+            print(f"Error parsing config file: {error}")
+            return
+        if max_connects < 1:
+            print("Error parsing config file: max-connects must be at least 1")
+            return
+        self._max_connects = max_connects
+
+    def get_max_connects(self) -> int:
+        """
+        Get the max-connects entry from the config
+        """
+
+        return self._max_connects
+
 
 class BackendServer:
     """
@@ -32,10 +150,48 @@ class BackendServer:
     IM networks
     """
 
-    def __init__(self) -> None:
+    __slots__ = ("connections", "connect_limit", "based")
+
+    # based callbacks and the names of the methods that handle them
+    CALLBACKS: ClassVar[Tuple[Tuple[Callback, str], ...]] = (
+        # based events
+        (Callback.BASED_CONFIG, "based_config"),
+        (Callback.BASED_INTERRUPT, "based_interrupt"),
+        (Callback.BASED_QUIT, "based_quit"),
+
+        # nuqql messages
+        (Callback.QUIT, "stop_task"),
+        (Callback.HELP_WELCOME, "_help_welcome"),
+        (Callback.HELP_ACCOUNT_ADD, "_help_account_add"),
+        (Callback.ADD_ACCOUNT, "add_account"),
+        (Callback.DEL_ACCOUNT, "del_account"),
+        (Callback.GET_BUDDIES, "handle_command"),
+        (Callback.SEND_MESSAGE, "send_message"),
+        (Callback.SET_STATUS, "handle_command"),
+        (Callback.GET_STATUS, "handle_command"),
+        (Callback.CHAT_LIST, "handle_command"),
+        (Callback.CHAT_JOIN, "handle_command"),
+        (Callback.CHAT_PART, "handle_command"),
+        (Callback.CHAT_SEND, "chat_send"),
+        (Callback.CHAT_USERS, "handle_command"),
+        (Callback.CHAT_INVITE, "handle_command"),
+    )
+
+    def __init__(self,
+                 max_connects: int = MAX_CONCURRENT_CONNECTS) -> None:
         self.connections: Dict[int, BackendClient] = {}
+
+        # limit for concurrent connection attempts of all clients
+        self.connect_limit = asyncio.Semaphore(max_connects)
         self.based = Based("matrixd-nio", VERSION)
 
+        # replace the based config with one that also reads the matrixd
+        # options, based keeps a reference in its accounts and server
+        config = MatrixdConfig("matrixd-nio", VERSION, max_connects)
+        self.based.config = config
+        self.based.accounts.config = config
+        self.based.server.config = config
+
     async def start(self) -> None:
         """
         Start server
@@ -43,42 +199,31 @@ class BackendServer:
 
         # set callbacks
         callbacks: "CallbackList" = [
-            # based events
-            (Callback.BASED_INTERRUPT, self.based_interrupt),
-            (Callback.BASED_QUIT, self.based_quit),
-
-            # nuqql messages
-            (Callback.QUIT, self.stop_task),
-            (Callback.HELP_WELCOME, self._help_welcome),
-            (Callback.HELP_ACCOUNT_ADD, self._help_account_add),
-            (Callback.ADD_ACCOUNT, self.add_account),
-            (Callback.DEL_ACCOUNT, self.del_account),
-            (Callback.GET_BUDDIES, self.handle_command),
-            (Callback.SEND_MESSAGE, self.send_message),
-            (Callback.SET_STATUS, self.handle_command),
-            (Callback.GET_STATUS, self.handle_command),
-            (Callback.CHAT_LIST, self.handle_command),
-            (Callback.CHAT_JOIN, self.handle_command),
-            (Callback.CHAT_PART, self.handle_command),
-            (Callback.CHAT_SEND, self.chat_send),
-            (Callback.CHAT_USERS, self.handle_command),
-            (Callback.CHAT_INVITE, self.handle_command),
-        ]
+            (callback, getattr(self, name))
+            for callback, name in self.CALLBACKS]
         self.based.set_callbacks(callbacks)
 
         # start based
         await self.based.start()
 
+    def _get_client(self,
+                    account: Optional["Account"]) -> Optional[BackendClient]:
+        """
+        Get client connection of account, None if there is no connection
+        """
+
+        if account is None:
+            return None
+        return self.connections.get(account.aid)
+
     async def handle_command(self, account: Optional["Account"], cmd: Callback,
                              params: Tuple) -> str:
         """
         Handle command in account/client
         """
 
-        assert account
-        try:
-            client = self.connections[account.aid]
-        except KeyError:
+        client = self._get_client(account)
+        if client is None:
             # no active connection
             return ""
 
@@ -92,19 +237,24 @@ class BackendServer:
         send a message to a destination  on an account
         """
 
-        # parse parameters
-        if len(params) > 2:
-            dest, msg, msg_type = params
-        else:
+        # parse parameters, based sends (dest, msg) tuples
+        try:
             dest, msg = params
             msg_type = "chat"
+        except ValueError:
+            dest, msg, msg_type = params
+
+        return await self._send(account, cmd, dest, msg, msg_type)
+
+    async def _send(self, account: Optional["Account"], cmd: Callback,
+                    dest: str, msg: str, msg_type: str) -> str:
+        """
+        Send a html-escaped message to a destination on an account
+        """
 
         # nuqql sends a html-escaped message; construct "plain-text" version
         # and xhtml version using nuqql's message and use them as message body
-        # later
-        html_msg = f'<body xmlns="http://www.w3.org/1999/xhtml">{msg}</body>'
-        msg = html.unescape(msg)
-        msg = "\n".join(re.split("<br/>", msg, flags=re.IGNORECASE))
+        msg, html_msg = _prepare_body(msg)
 
         # send message
         await self.handle_command(account, cmd, (unescape_name(dest), msg,
@@ -121,8 +271,8 @@ class BackendServer:
         chat, msg = params
         # TODO: use cmd to infer msg type in send_message and remove this
         # function?
-        return await self.send_message(account, Callback.SEND_MESSAGE,
-                                       (chat, msg, "groupchat"))
+        return await self._send(account, Callback.SEND_MESSAGE, chat, msg,
+                                "groupchat")
 
     async def add_account(self, account: Optional["Account"], _cmd: Callback,
                           _params: Tuple) -> str:
@@ -131,12 +281,15 @@ class BackendServer:
         """
 
         # only handle matrix accounts
-        assert account
-        if account.type != "matrix":
+        if account is None or account.type != "matrix":
+            return ""
+
+        # do not start a second client for an account that is already active
+        if account.aid in self.connections:
             return ""
 
         # init client connection
-        client = BackendClient(account)
+        client = BackendClient(account, self.connect_limit)
 
         # save client connection in active connections dictionary
         self.connections[account.aid] = client
@@ -153,14 +306,14 @@ class BackendServer:
         stop matrix client task for it
         """
 
-        # let client clean up
-        assert account
-        client = self.connections[account.aid]
+        # remove client from active connections and let it clean up
+        if account is None:
+            return ""
+        client = self.connections.pop(account.aid, None)
+        if client is None:
+            return ""
         await client.stop()
-        client.del_account()
-
-        # cleanup
-        del self.connections[account.aid]
+        await client.del_account()
 
         return ""
 
@@ -171,14 +324,7 @@ class BackendServer:
         Handle account add help event
         """
 
-        add_help = Message.info("You do not have any accounts configured.")
-        add_help += Message.info("You can add a new matrix account with the "
-                                 "following command: "
-                                 "account add matrix <username>@<homeserver> "
-                                 "<password>")
-        add_help += Message.info("Example: account add matrix "
-                                 "dummy@matrix.org MyPassword")
-        return add_help
+        return ACCOUNT_ADD_HELP
 
     async def _help_welcome(self, _account: Optional["Account"],
                             _cmd: Callback, _params: Tuple) -> str:
@@ -186,12 +332,9 @@ class BackendServer:
         Handle welcome help message event
         """
 
-        welcome = Message.info(f"Welcome to nuqql-matrixd-nio v{VERSION}!")
-        welcome += Message.info("Enter \"help\" for a list of available "
-                                "commands and their help texts")
         if self.based.config.get_push_accounts():
-            welcome += Message.info("Listing your accounts:")
-        return welcome
+            return WELCOME_HELP + WELCOME_ACCOUNTS_HELP
+        return WELCOME_HELP
 
     async def stop_task(self, account: Optional["Account"], _cmd: Callback,
                         _params: Tuple) -> str:
@@ -201,20 +344,35 @@ class BackendServer:
 
         # stop task
         print("Signalling account tasks to stop.")
-        assert account
-        client = self.connections[account.aid]
+        client = self._get_client(account)
+        if client is None:
+            return ""
         await client.stop()
         return ""
 
+    async def based_config(self, _account: Optional["Account"],
+                           _cmd: Callback, params: Tuple) -> str:
+        """
+        Config event in based, apply matrixd specific options
+        """
+
+        # config is loaded before the accounts, so no client is using the
+        # connect limit yet
+        config, = params
+        self.connect_limit = asyncio.Semaphore(config.get_max_connects())
+        return ""
+
     async def based_interrupt(self, _account: Optional["Account"],
                               _cmd: Callback, _params: Tuple) -> str:
         """
         KeyboardInterrupt event in based
         """
 
-        for client in self.connections.values():
-            print("Signalling account task to stop.")
-            await client.stop()
+        # stop all clients concurrently
+        print("Signalling account tasks to stop.")
+        await asyncio.gather(*[client.stop()
+                               for client in self.connections.values()],
+                             return_exceptions=True)
         return ""
 
     async def based_quit(self, _account: Optional["Account"], _cmd: Callback,
@@ -224,7 +382,8 @@ class BackendServer:
         """
 
         print("Waiting for all tasks to finish. This might take a while.")
-        for client in self.connections.values():
-            assert client.task
-            await client.task
+        # wait for all client tasks concurrently
+        tasks = [client.task for client in self.connections.values()
+                 if client.task]
+        await asyncio.gather(*tasks, return_exceptions=True)
         return ""
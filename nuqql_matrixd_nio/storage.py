@@ -0,0 +1,129 @@
+"""
+file, serialization and cache helpers
+"""
+
+import json
+import os
+import stat
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+try:
+    import orjson  # type: ignore
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+# suffix of temporary files written before replacing the actual file
+TMP_FILE_SUFFIX = ".tmp"
+
+
+def read_credentials_file(credentials_file: str) -> Tuple[str, str, str]:
+    """
+    Read user id, device id and access token from credentials file
+    """
+
+    if not os.path.exists(credentials_file):
+        return ("", "", "")
+
+    with open(credentials_file, "rb") as cred_file:
+        creds = json_loads(cred_file.read())
+    return creds["user_id"], creds["device_id"], creds["access_token"]
+
+
+def write_credentials_file(credentials_file: str, data: bytes) -> None:
+    """
+    Write serialized login details to credentials file
+    """
+
+    # write the login details to a temporary file first and replace the
+    # credentials file with it, so the file is never left corrupted
+    tmp_file = credentials_file + TMP_FILE_SUFFIX
+    tmp_fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     stat.S_IRUSR | stat.S_IWUSR)
+    with open(tmp_fd, "wb") as cred_file:
+        cred_file.write(data)
+        cred_file.flush()
+        os.fsync(cred_file.fileno())
+    os.replace(tmp_file, credentials_file)
+
+
+def read_sync_token_file(sync_token_file: Path) -> str:
+    """
+    Read sync token from sync token file
+    """
+
+    # a missing file is handled like an empty one, the file is created with
+    # user-only permissions when the token is written
+    try:
+        with open(sync_token_file, "r", encoding='UTF-8') as token_file:
+            token = token_file.readline()
+    except OSError:
+        token = ""
+
+    return token
+
+
+def write_sync_token_file(sync_token_file: Path, token: str) -> bool:
+    """
+    Write sync token to sync token file, return True if successful
+    """
+
+    # write token to a temporary file first and replace the token file
+    # with it, so the token file is never left partially written
+    tmp_file = str(sync_token_file) + TMP_FILE_SUFFIX
+    try:
+        tmp_fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         stat.S_IRUSR | stat.S_IWUSR)
+        with open(tmp_fd, "w", encoding='UTF-8') as token_file:
+            token_file.write(token)
+        os.replace(tmp_file, sync_token_file)
+    except OSError:
+        return False
+
+    return True
+
+
+def delete_sync_token_file(sync_token_file: Path) -> None:
+    """
+    Delete sync token file
+    """
+
+    if not sync_token_file.exists():
+        return
+
+    os.remove(sync_token_file)
+
+
+def json_dumps(obj: Dict[str, Any]) -> bytes:
+    """
+    Serialize obj to UTF-8 encoded JSON, use orjson if available
+    """
+
+    if HAVE_ORJSON:
+        return orjson.dumps(obj)  # pylint: disable=no-member
+    return json.dumps(obj).encode("UTF-8")
+
+
+def json_loads(data: bytes) -> Any:
+    """
+    Deserialize UTF-8 encoded JSON data, use orjson if available
+    """
+
+    if HAVE_ORJSON:
+        return orjson.loads(data)  # pylint: disable=no-member
+    return json.loads(data)
+
+
+def cache_store(cache: "OrderedDict[str, str]", key: str, value: str,
+                size: int) -> None:
+    """
+    Store value in least recently used cache, remove oldest entry if cache
+    is larger than size
+    """
+
+    cache[key] = value
+    if len(cache) > size:
+        cache.popitem(last=False)
@@ -12,12 +12,11 @@ from setuptools import setup
 
 # setup parameters
 DESCRIPTION = "Matrix client network daemon using matrix-nio"
-with open("README.md", 'r', encoding='UTF-8') as f:
-    LONG_DESCRIPTION = f.read()
 CLASSIFIERS = [
     "Programming Language :: Python :: 3",
     "License :: OSI Approved :: MIT License",
 ]
+VERSION_RE = re.compile(r"^VERSION = ['\"]([^'\"]*)['\"]", re.M)
 
 
 # setup helpers
@@ -27,7 +26,8 @@ def read(*parts):
     """
 
     here = os.path.abspath(os.path.dirname(__file__))
-    with codecs.open(os.path.join(here, *parts), 'r') as enc_file:
+    with codecs.open(os.path.join(here, *parts), 'r',
+                     encoding='UTF-8') as enc_file:
         return enc_file.read()
 
 
@@ -37,8 +37,7 @@ def find_version(*file_paths):
     """
 
     version_file = read(*file_paths)
-    version_pattern = r"^VERSION = ['\"]([^'\"]*)['\"]"
-    version_match = re.search(version_pattern, version_file, re.M)
+    version_match = VERSION_RE.search(version_file)
     if version_match:
         return version_match.group(1)
     raise RuntimeError("Unable to find version string.")
@@ -50,7 +49,7 @@ setup(
     version=find_version("nuqql_matrixd_nio", "server.py"),
     description=DESCRIPTION,
     license="MIT",
-    long_description=LONG_DESCRIPTION,
+    long_description=read("README.md"),
     long_description_content_type="text/markdown",
     author="hwipl",
     author_email="nuqql-matrixd@hwipl.net",